@@ -2,12 +2,16 @@
 import time
 import json
 import os
+import sys
+import pickle
+import tempfile
 import warnings
 import requests
 import re
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from ipaddress import ip_address
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Iterable, Iterator, Optional, Tuple
 
 from authlib.deprecate import AuthlibDeprecationWarning
 
@@ -30,6 +34,39 @@ RUNZERO_CLIENT_ID = os.environ.get('RUNZERO_CLIENT_ID')
 RUNZERO_CLIENT_SECRET = os.environ.get('RUNZERO_CLIENT_SECRET')
 MAX_NETWORK_INTERFACES = 1
 
+# --- Device Spooling ---
+# Once this many compact device records are held in memory they are written to a
+# binary temp file and released. Set to 0 to keep everything in memory.
+SPOOL_THRESHOLD = int(os.environ.get('ABSOLUTE_SPOOL_THRESHOLD', '25000'))
+
+# --- Adaptive Paging ---
+# Absolute's reporting API accepts at most 500 devices per page. The page size
+# is fixed once a nextPage cursor exists; each run reports a recommended
+# ABSOLUTE_PAGE_SIZE for the next one from measured throughput.
+ABSOLUTE_MIN_PAGE_SIZE = 50
+ABSOLUTE_MAX_PAGE_SIZE = 500
+ABSOLUTE_PAGE_SIZE = int(os.environ.get('ABSOLUTE_PAGE_SIZE', str(ABSOLUTE_MAX_PAGE_SIZE)))
+ABSOLUTE_TARGET_LATENCY = float(os.environ.get('ABSOLUTE_TARGET_LATENCY', '10'))  # seconds per page
+ABSOLUTE_MIN_TIMEOUT = 15
+ABSOLUTE_MAX_TIMEOUT = 120
+ABSOLUTE_MAX_RETRIES = 5
+ABSOLUTE_MAX_RETRY_DELAY = 120  # caps Retry-After and exponential backoff, seconds
+ABSOLUTE_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Top-level Absolute fields mapped onto ImportAsset directly; everything else
+# becomes a flattened custom attribute.
+MAPPED_KEYS = {
+    "deviceUid", "deviceName", "platformOSType", "systemManufacturer",
+    "systemModel", "networkAdapters", "localIp", "operatingSystem", "esn", "fullSystemName"
+}
+
+# (ipV4Address, ipV6Address, macAddress) as reported for a network adapter.
+Adapter = Tuple[Optional[str], Optional[str], Optional[str]]
+
+# One shared key tuple per distinct flattened attribute layout. Devices of the
+# same model and configuration flatten to the same keys, so they share a tuple.
+_ATTRIBUTE_LAYOUTS: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
 def flatten_json(d: Any, parent_key: str = '', sep: str = '_') -> Dict[str, str]:
     """
     Recursively flattens nested dictionaries and lists into a single level.
@@ -65,6 +102,228 @@ def format_mac(mac: str) -> str:
         return ":".join(clean_mac[i:i+2] for i in range(0, 12, 2))
     return None
 
+class CompactDevice:
+    """
+    Minimal per-device record kept between fetch and upload.
+    Only the fields read by the runZero mapping are retained. All other subtrees
+    (displays, keyboards, printers, usbs, ...) are flattened as soon as the page
+    is parsed, so the nested JSON is freed. Each flattened attribute is stored as
+    a shared key tuple (attr_keys) plus a tuple of interned values (attr_values).
+    """
+    __slots__ = (
+        "device_uid", "hostname", "os", "os_version", "manufacturer",
+        "model", "local_ip", "adapters", "last_connected", "attr_keys", "attr_values",
+    )
+
+    def __init__(self, device_uid: Optional[str], hostname: str, os: str, os_version: str,
+                 manufacturer: str, model: str, local_ip: Optional[str],
+                 adapters: Tuple[Adapter, ...], last_connected: Optional[str],
+                 attr_keys: Tuple[str, ...], attr_values: Tuple[str, ...]):
+        self.device_uid = device_uid
+        self.hostname = hostname
+        self.os = os
+        self.os_version = os_version
+        self.manufacturer = manufacturer
+        self.model = model
+        self.local_ip = local_ip
+        self.adapters = adapters
+        self.last_connected = last_connected
+        self.attr_keys = attr_keys
+        self.attr_values = attr_values
+
+    @property
+    def attributes(self) -> Iterator[Tuple[str, str]]:
+        """Yields the flattened custom attributes as (key, value) pairs."""
+        return zip(self.attr_keys, self.attr_values)
+
+def compact_device(d: Dict[str, Any]) -> CompactDevice:
+    """Reduces a raw Absolute device dict to a CompactDevice, dropping subtrees that are not needed."""
+    adapters = tuple(
+        (a.get("ipV4Address"), a.get("ipV6Address"), a.get("macAddress"))
+        for a in (d.get("networkAdapters") or [])
+        if isinstance(a, dict)
+    )
+    unmapped = {k: v for k, v in d.items() if k not in MAPPED_KEYS}
+    flat = flatten_json(unmapped)
+    layout = tuple(flat)
+    attr_keys = _ATTRIBUTE_LAYOUTS.get(layout)
+    if attr_keys is None:
+        attr_keys = tuple(sys.intern(k) for k in layout)
+        _ATTRIBUTE_LAYOUTS[attr_keys] = attr_keys
+    # Repeated values (models, versions, vendor names) share a single string.
+    attr_values = tuple(sys.intern(v) for v in flat.values())
+
+    return CompactDevice(
+        device_uid=d.get("deviceUid"),
+        hostname=str(d.get("fullSystemName") or ""),
+        os=sys.intern(str(d.get("platformOSType") or "")),
+        os_version=sys.intern(str((d.get("operatingSystem") or {}).get("version") or "")),
+        manufacturer=sys.intern(str(d.get("systemManufacturer") or "")),
+        model=sys.intern(str(d.get("systemModel") or "")),
+        local_ip=d.get("localIp"),
+        adapters=adapters,
+        last_connected=d.get("lastConnectedDateTimeUtc"),
+        attr_keys=attr_keys,
+        attr_values=attr_values,
+    )
+
+class DeviceSpool:
+    """
+    Append-only collection of CompactDevice records.
+    Records are held in memory until SPOOL_THRESHOLD is reached, then pickled in
+    chunks to an anonymous temp file. Iteration replays spooled chunks in order
+    followed by whatever is still in memory.
+    """
+
+    def __init__(self, threshold: int = SPOOL_THRESHOLD):
+        self.threshold = threshold
+        self._memory: List[CompactDevice] = []
+        self._file = None
+        self._spooled = 0
+
+    def __len__(self) -> int:
+        return self._spooled + len(self._memory)
+
+    def extend(self, devices: Iterable[CompactDevice]) -> None:
+        self._memory.extend(devices)
+        if self.threshold > 0 and len(self._memory) >= self.threshold:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="absolute-devices-")
+        self._file.seek(0, os.SEEK_END)
+        pickle.dump(self._memory, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spooled += len(self._memory)
+        self._memory = []
+
+    def __iter__(self) -> Iterator[CompactDevice]:
+        if self._file is not None:
+            self._file.flush()
+            self._file.seek(0)
+            while True:
+                try:
+                    chunk = pickle.load(self._file)
+                except EOFError:
+                    break
+                yield from chunk
+        yield from self._memory
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header given as delta-seconds or as an HTTP-date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class AdaptivePager:
+    """
+    Chooses page size, timeout and retry delays for Absolute requests.
+    Absolute paginates with an opaque nextPage cursor, and nothing documents that
+    pageSize may change part way through one. The page size is therefore only
+    reduced while the first page is being retried, and is locked once a page
+    succeeds. Timeouts follow observed latency throughout. Measured bytes/s give
+    the recommended ABSOLUTE_PAGE_SIZE for the next run. Pages are fetched one at
+    a time, so concurrency is not tunable.
+    """
+
+    def __init__(self, page_size: int = ABSOLUTE_PAGE_SIZE):
+        self.page_size = max(ABSOLUTE_MIN_PAGE_SIZE, min(ABSOLUTE_MAX_PAGE_SIZE, page_size))
+        self.locked = False  # set once a cursor chain has started
+        self.latency: Optional[float] = None  # exponentially weighted, seconds
+        self.metrics: Dict[str, Any] = {
+            "pages": 0,
+            "records": 0,
+            "bytes": 0,
+            "seconds": 0.0,
+            "retries": 0,
+            "throttled": 0,
+            "timeouts": 0,
+        }
+
+    @property
+    def timeout(self) -> float:
+        """Allows several times the observed latency, within fixed bounds."""
+        if self.latency is None:
+            return ABSOLUTE_MAX_TIMEOUT
+        return max(ABSOLUTE_MIN_TIMEOUT, min(ABSOLUTE_MAX_TIMEOUT, self.latency * 4))
+
+    def observe_latency(self, seconds: float) -> None:
+        """Folds a response time into the latency estimate used for timeouts."""
+        self.latency = seconds if self.latency is None else 0.7 * self.latency + 0.3 * seconds
+
+    def record_page(self, seconds: float, size_bytes: int, records: int) -> None:
+        """Updates throughput metrics and locks the page size for the cursor chain."""
+        self.observe_latency(seconds)
+        self.metrics["pages"] += 1
+        self.metrics["records"] += records
+        self.metrics["bytes"] += size_bytes
+        self.metrics["seconds"] += seconds
+        self.locked = True
+
+    def record_timeout(self) -> None:
+        """Treats the expired timeout as a lower bound on latency so the next attempt waits longer."""
+        self.metrics["timeouts"] += 1
+        self.latency = max(self.latency or 0.0, self.timeout)
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None, throttled: bool = False, shrink: bool = False) -> None:
+        """
+        Sleeps before retrying a failed page.
+        Throttling only delays the retry, since smaller pages would mean more requests.
+        Slow pages (timeouts, 5xx) also halve the page size if no cursor exists yet.
+        """
+        self.metrics["retries"] += 1
+        if throttled:
+            self.metrics["throttled"] += 1
+        if shrink and not self.locked:
+            self.page_size = max(ABSOLUTE_MIN_PAGE_SIZE, self.page_size // 2)
+
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = 2 ** attempt
+        delay = min(ABSOLUTE_MAX_RETRY_DELAY, delay)
+        print(f"Retrying in {delay:.0f}s with pageSize={self.page_size}...")
+        time.sleep(delay)
+
+    def recommended_page_size(self) -> int:
+        """Page size expected to download in ABSOLUTE_TARGET_LATENCY at the measured bytes/s."""
+        records, size_bytes, seconds = self.metrics["records"], self.metrics["bytes"], self.metrics["seconds"]
+        if not records or not size_bytes or not seconds:
+            return self.page_size
+        bytes_per_device = size_bytes / records
+        target = (size_bytes / seconds) * ABSOLUTE_TARGET_LATENCY / bytes_per_device
+        return max(ABSOLUTE_MIN_PAGE_SIZE, min(ABSOLUTE_MAX_PAGE_SIZE, int(target)))
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the settings chosen during the run along with observed throughput."""
+        seconds = self.metrics["seconds"]
+        return {
+            "pages": self.metrics["pages"],
+            "retries": self.metrics["retries"],
+            "throttled": self.metrics["throttled"],
+            "timeouts": self.metrics["timeouts"],
+            "page_size": self.page_size,
+            "recommended_page_size": self.recommended_page_size(),
+            "avg_latency_s": round(seconds / self.metrics["pages"], 2) if self.metrics["pages"] else 0,
+            "bytes_per_s": round(self.metrics["bytes"] / seconds) if seconds else 0,
+            "final_timeout_s": round(self.timeout, 1),
+        }
+
 def get_absolute_jws(method: str, uri: str, query_string: str, payload: Dict) -> str:
     """Constructs the JWS string required for Absolute API v3 authentication."""
     if not isinstance(ABSOLUTE_TOKEN_ID, str) or not ABSOLUTE_TOKEN_ID.strip():
@@ -96,11 +355,11 @@ def get_absolute_jws(method: str, uri: str, query_string: str, payload: Dict) ->
         return token.tobytes().decode("utf-8")
     return str(token)
 
-def fetch_all_absolute_devices() -> List[Dict[str, Any]]:
+def fetch_all_absolute_devices(pager: AdaptivePager = None) -> DeviceSpool:
     """Retrieves active devices seen within the last 3 days using comprehensive field selection."""
-    all_devices = []
+    all_devices = DeviceSpool()
     next_page_token = None
-    page_size = 500 
+    pager = pager or AdaptivePager()
     uri = "/v3/reporting/devices"
     
     three_days_ago = (datetime.now(timezone.utc) - timedelta(days=60)).isoformat().replace('+00:00', 'Z')
@@ -116,30 +375,54 @@ def fetch_all_absolute_devices() -> List[Dict[str, Any]]:
     )
     
     print(f"Beginning data retrieval from Absolute (Active since: {three_days_ago})...")
+    url = f"{ABSOLUTE_BASE_URL}/jws/validate"
     while True:
-        query_parts = [
-            f"pageSize={page_size}", 
-            "agentStatus=A",
-            f"lastConnectedDateTimeUtcFromInclusive={three_days_ago}",
-            f"select={selected_fields}"
-        ]
-        if next_page_token:
-            query_parts.append(f"nextPage={next_page_token}")
-        
-        current_query_string = "&".join(query_parts)
-        signed_jws = get_absolute_jws("GET", uri, current_query_string, {})
-        
-        url = f"{ABSOLUTE_BASE_URL}/jws/validate"
-        
-        response = requests.post(url, data=signed_jws, headers={"Content-Type": "text/plain"}, timeout=60)
-        
+        response = None
+        for attempt in range(ABSOLUTE_MAX_RETRIES + 1):
+            query_parts = [
+                f"pageSize={pager.page_size}", 
+                "agentStatus=A",
+                f"lastConnectedDateTimeUtcFromInclusive={three_days_ago}",
+                f"select={selected_fields}"
+            ]
+            if next_page_token:
+                query_parts.append(f"nextPage={next_page_token}")
+            
+            # Re-signed on every attempt so issuedAt stays fresh.
+            current_query_string = "&".join(query_parts)
+            signed_jws = get_absolute_jws("GET", uri, current_query_string, {})
+            
+            started = time.monotonic()
+            try:
+                response = requests.post(url, data=signed_jws, headers={"Content-Type": "text/plain"}, timeout=pager.timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                print(f"Warning: Request failed after {time.monotonic() - started:.1f}s: {e}")
+                response = None
+                timed_out = isinstance(e, requests.exceptions.Timeout)
+                if timed_out:
+                    pager.record_timeout()
+                if attempt < ABSOLUTE_MAX_RETRIES:
+                    pager.backoff(attempt, shrink=timed_out)
+                continue
+
+            if response.status_code in ABSOLUTE_RETRY_STATUS and attempt < ABSOLUTE_MAX_RETRIES:
+                print(f"Warning: {response.status_code} from Absolute.")
+                throttled = response.status_code == 429
+                pager.backoff(attempt, response.headers.get("Retry-After"), throttled=throttled, shrink=not throttled)
+                continue
+            break
+
+        if response is None:
+            print("Error: Absolute did not respond after retries.")
+            break
         if response.status_code != 200:
             print(f"Error: {response.status_code} - {response.text}")
             break
             
         res_json = response.json()
         page_data = res_json.get("data", [])
-        all_devices.extend(page_data)
+        pager.record_page(time.monotonic() - started, len(response.content), len(page_data))
+        all_devices.extend(compact_device(d) for d in page_data)
         print(f"Downloaded {len(all_devices)} devices...")
         
         pagination = res_json.get("metadata", {}).get("pagination", {})
@@ -148,6 +431,7 @@ def fetch_all_absolute_devices() -> List[Dict[str, Any]]:
         if not next_page_token:
             break 
             
+    print(f"Absolute paging metrics: {json.dumps(pager.summary())}")
     return all_devices
 
 def build_network_interface(ips: List[str], mac: str = None) -> NetworkInterface:
@@ -181,12 +465,13 @@ def parse_valid_ip(ip: str):
     except Exception:
         return None
 
-def score_adapter(adapter: Dict[str, Any], local_ip: str = None) -> int:
+def score_adapter(adapter: Adapter, local_ip: str = None) -> int:
     """Scores adapters so primary/stable interfaces are chosen first."""
     score = 0
-    ip4_obj = parse_valid_ip(adapter.get("ipV4Address"))
-    ip6_obj = parse_valid_ip(adapter.get("ipV6Address"))
-    mac = format_mac(adapter.get("macAddress"))
+    ipv4, ipv6, raw_mac = adapter
+    ip4_obj = parse_valid_ip(ipv4)
+    ip6_obj = parse_valid_ip(ipv6)
+    mac = format_mac(raw_mac)
 
     if mac:
         score += 10
@@ -202,12 +487,12 @@ def score_adapter(adapter: Dict[str, Any], local_ip: str = None) -> int:
 
     return score
 
-def select_network_interfaces(device: Dict[str, Any], max_interfaces: int = MAX_NETWORK_INTERFACES) -> List[NetworkInterface]:
+def select_network_interfaces(device: CompactDevice, max_interfaces: int = MAX_NETWORK_INTERFACES) -> List[NetworkInterface]:
     """Selects a small, high-confidence set of interfaces from Absolute data."""
     selected: List[NetworkInterface] = []
     seen_keys = set()
-    local_ip = device.get("localIp")
-    adapters = device.get("networkAdapters", [])
+    local_ip = device.local_ip
+    adapters = device.adapters
 
     scored_adapters = sorted(
         adapters,
@@ -215,16 +500,16 @@ def select_network_interfaces(device: Dict[str, Any], max_interfaces: int = MAX_
         reverse=True,
     )
 
-    for adapter in scored_adapters:
+    for ipv4, ipv6, raw_mac in scored_adapters:
         ip_candidates = []
-        ip4_obj = parse_valid_ip(adapter.get("ipV4Address"))
-        ip6_obj = parse_valid_ip(adapter.get("ipV6Address"))
+        ip4_obj = parse_valid_ip(ipv4)
+        ip6_obj = parse_valid_ip(ipv6)
         if ip4_obj:
             ip_candidates.append(str(ip4_obj))
         if ip6_obj:
             ip_candidates.append(str(ip6_obj))
 
-        iface = build_network_interface(ips=ip_candidates, mac=adapter.get("macAddress"))
+        iface = build_network_interface(ips=ip_candidates, mac=raw_mac)
         if not iface:
             continue
 
@@ -252,24 +537,18 @@ def select_network_interfaces(device: Dict[str, Any], max_interfaces: int = MAX_
 
     return selected
 
-def build_runzero_assets(devices: List[Dict[str, Any]]) -> List[ImportAsset]:
+def build_runzero_assets(devices: Iterable[CompactDevice]) -> List[ImportAsset]:
     """Maps Absolute data to runZero assets with epoch timestamp conversion."""
     assets = []
-    
-    mapped_keys = {
-        "deviceUid", "deviceName", "platformOSType", "systemManufacturer", 
-        "systemModel", "networkAdapters", "localIp", "operatingSystem", "esn", "fullSystemName"
-    }
 
     for d in devices:
         networks = select_network_interfaces(d)
 
-        # 2. Flatten and Filter Custom Attributes
-        raw_flat = flatten_json(d)
+        # 2. Custom Attributes (already flattened and filtered in compact_device)
         custom_attrs = {}
         
         # --- Convert lastConnectedDateTimeUtc to Epoch ---
-        iso_time = d.get("lastConnectedDateTimeUtc")
+        iso_time = d.last_connected
         if iso_time:
             try:
                 dt = datetime.fromisoformat(iso_time.replace('Z', '+00:00'))
@@ -279,20 +558,17 @@ def build_runzero_assets(devices: List[Dict[str, Any]]) -> List[ImportAsset]:
                 print(f"Warning: Could not parse timestamp {iso_time}: {e}")
         # -------------------------------------------------------------
 
-        for key, value in raw_flat.items():
-            base_key = key.split('_')[0]
-            if base_key not in mapped_keys:
-                custom_attrs[key] = value
+        custom_attrs.update(d.attributes)
 
         # 3. Build ImportAsset
         assets.append(
             ImportAsset(
-                id=d.get("deviceUid"), 
-                hostname=str(d.get("fullSystemName") or ""),
-                os=str(d.get("platformOSType") or ""),
-                osVersion=str(d.get("operatingSystem", {}).get("version") or ""),
-                manufacturer=str(d.get("systemManufacturer") or ""),
-                model=str(d.get("systemModel") or ""),
+                id=d.device_uid, 
+                hostname=d.hostname,
+                os=d.os,
+                osVersion=d.os_version,
+                manufacturer=d.manufacturer,
+                model=d.model,
                 networkInterfaces=networks,
                 customAttributes=custom_attrs
             )
@@ -302,11 +578,17 @@ def build_runzero_assets(devices: List[Dict[str, Any]]) -> List[ImportAsset]:
 # --- Main Execution ---
 
 if __name__ == "__main__":
-    raw_devices = fetch_all_absolute_devices()
+    pager = AdaptivePager()
+    raw_devices = fetch_all_absolute_devices(pager)
     print(f"Final Count: {len(raw_devices)} devices retrieved.")
 
     if raw_devices:
-        runzero_assets = build_runzero_assets(raw_devices)
+        # Spooling only bounds memory during the fetch: the SDK uploads a full
+        # list, so every ImportAsset is held in memory at once from here on.
+        try:
+            runzero_assets = build_runzero_assets(raw_devices)
+        finally:
+            raw_devices.close()
         
         c = runzero.Client()
         c.oauth_login(RUNZERO_CLIENT_ID, RUNZERO_CLIENT_SECRET)
@@ -325,6 +607,9 @@ if __name__ == "__main__":
             site_id=site.id,
             custom_integration_id=my_asset_source.id, 
             assets=runzero_assets,
-            task_info=ImportTask(name="Absolute Inventory Full Attribute Sync"),
+            task_info=ImportTask(
+                name="Absolute Inventory Full Attribute Sync",
+                description=f"Absolute paging: {json.dumps(pager.summary())}",
+            ),
         )
         print(f"Successfully submitted {len(runzero_assets)} assets with full attributes to runZero.")
\ No newline at end of file